@@ -36,12 +36,13 @@
 # =============================================================================
 """ Experimental quantsim utilities """
 
-from typing import overload, Callable, Type
+import functools
+from typing import overload, Callable, Dict, List, Optional, Tuple, Type, Union
 import torch
 
 from aimet_common.utils import AimetLogger
 from aimet_common.connected_graph.product import Product
-from aimet_torch.meta.connectedgraph import Op
+from aimet_torch.meta.connectedgraph import ConnectedGraph, Op
 from aimet_torch.v2.nn import BaseQuantizationMixin, custom
 from aimet_torch.v2.quantization.affine.quantizer import AffineQuantizerBase
 from aimet_torch.v2.quantsim import QuantizationSimModel
@@ -61,81 +62,99 @@ _MATH_INVARIANT_OPS = (
 
 
 def _is_math_invariant_op(module: torch.nn.Module):
-    return isinstance(module, _MATH_INVARIANT_OPS)
+    return _is_math_invariant_type(type(module))
 
 
-@overload
-def propagate_output_encodings(sim: QuantizationSimModel, module_type: Type[torch.nn.Module]):
-    """ Propagate output encodings of the given module type """
-
-
-@overload
-def propagate_output_encodings(sim: QuantizationSimModel, qmodule: torch.nn.Module):
-    """ Propagate output encodings of qmodule """
-
+@functools.lru_cache(None)
+def _is_math_invariant_type(module_type: Type[torch.nn.Module]):
+    # qmodules are subclasses of the math invariant ops (e.g. QuantizedReshape),
+    # so exact type comparison isn't enough. Cache the subclass check per type instead
+    return issubclass(module_type, _MATH_INVARIANT_OPS)
 
-@overload
-def propagate_output_encodings(sim: QuantizationSimModel, condition: Callable[[torch.nn.Module], bool]):
-    """ Propagate output encodings of all the modules that satisfies the given condition. """
 
+def _get_positions(products: List[Product]) -> Dict[int, int]:
+    """ Map the id of each product to its first position in the given list """
+    positions = {}
+    for i, product in enumerate(products):
+        positions.setdefault(id(product), i)
+    return positions
 
-def propagate_output_encodings(sim: QuantizationSimModel, arg):
-    """ Propagate output encodings of all the modules that satisfies the given condition. """
-
-    if isinstance(arg, type) and issubclass(arg, torch.nn.Module):
-        module_type = arg
-        condition = lambda module: isinstance(module, module_type)
-    elif isinstance(arg, torch.nn.Module):
-        qmodule = arg
-        condition = lambda module: module is qmodule
-    else:
-        condition = arg
-
-    if not sim.connected_graph:
-        msg = f"Couldn't find a traced graph from {type(sim).__qualname__}. "\
-              "propagate_output_encodings is only supported when traced graph is present "\
-              "as part of quantsim"
-        raise RuntimeError(msg)
 
-    _propagate_output_encodings(sim, condition)
+def _index_ops(cg: ConnectedGraph, qmodel: torch.nn.Module) \
+        -> Tuple[Dict[Op, torch.nn.Module], Dict[Op, Dict[int, int]], Dict[Op, Dict[int, int]]]:
+    """
+    Resolve the qmodule and the input/output product positions of each op once up front.
+    Resolving them on demand would re-walk the module tree for every visit during traversal
 
+    :param cg: Connected graph of the original model
+    :param qmodel: Quantized model
+    :return: Mapping from op to its associated qmodule, and
+        mappings from op to the positions of its input and output products
+    """
+    module_to_name = cg._module_to_name # pylint: disable=protected-access
+    qmodule_of_op: Dict[Op, torch.nn.Module] = {}
+    input_positions: Dict[Op, Dict[int, int]] = {}
+    output_positions: Dict[Op, Dict[int, int]] = {}
 
-def _propagate_output_encodings(sim: QuantizationSimModel,
-                                condition: Callable[[torch.nn.Module], bool]):
-    """ Propagate output encodings of all the modules that satisfies the given condition. """
-    # pylint: disable=redefined-builtin
-    cg = sim.connected_graph
-    qmodel = sim.model
+    for op in cg.ordered_ops:
+        input_positions[op] = _get_positions(op.inputs)
+        output_positions[op] = _get_positions(getattr(op, 'output_products', [op.output]))
 
-    def get_qmodule(op: Op):
         orig_module = op.get_module()
         if not orig_module:
-            return None
+            continue
+
+        full_name = module_to_name.get(orig_module)
+        if not full_name:
+            continue
 
-        full_name = cg._module_to_name[orig_module] # pylint: disable=protected-access
         _, *module_names = full_name.split('.')
 
         if not module_names:
-            return None
+            continue
 
         module_name = '.'.join(module_names)
-        return utils.get_named_module(qmodel, module_name)
+        qmodule_of_op[op] = utils.get_named_module(qmodel, module_name)
+
+    return qmodule_of_op, input_positions, output_positions
+
 
-    def _set_src_qtzr(x: Product, consumer: Op, qtzr):
+def _set_src_qtzr(consumer: Op,
+                  qtzr,
+                  qmodule_of_op: Dict[Op, torch.nn.Module],
+                  input_positions: Dict[Op, Dict[int, int]],
+                  output_positions: Dict[Op, Dict[int, int]]):
+    """
+    Set the quantizers of the source tensors of consumer to qtzr.
+
+    :param consumer: Op whose input encodings will be replaced with qtzr
+    :param qtzr: Quantizer to propagate
+    :param qmodule_of_op: Mapping from op to its associated qmodule
+    :param input_positions: Mapping from op to the positions of its input products
+    :param output_positions: Mapping from op to the positions of its output products
+    """
+    # pylint: disable=redefined-builtin
+    # Traverse the ancestors of ``consumer`` with an explicit worklist
+    # so that long chains of math invariant ops don't hit the recursion limit
+    stack = [(x, consumer) for x in consumer.inputs]
+    visited = set()
+
+    while stack:
+        x, consumer = stack.pop()
         producer = x.producer
 
         if not producer:
             if x.shape is None:
                 # ``x`` is a non-tensor root input
-                return
+                continue
 
             # ``x`` is a root input (i.e. has no producer).
             # In this case, set the input quantizer of the consumer to ``qtzr``
-            i = consumer.inputs.index(x)
-            qmodule = get_qmodule(consumer)
+            i = input_positions[consumer][id(x)]
+            qmodule = qmodule_of_op.get(consumer)
 
             if not qmodule:
-                return
+                continue
 
             if isinstance(qmodule, custom.Concat):
                 # torch.concat is an input-variadic operation whose number of inputs
@@ -144,15 +163,20 @@ def _propagate_output_encodings(sim: QuantizationSimModel,
                 # that gets applied to all input tensors
                 i = 0
             qmodule.input_quantizers[i] = qtzr
-            return
+            continue
+
+        if id(x) in visited:
+            # ``x`` is shared by multiple consumers (e.g. diamond-shaped graph)
+            # and its producer has already been processed
+            continue
+        visited.add(id(x))
 
-        qmodule = get_qmodule(producer)
+        qmodule = qmodule_of_op.get(producer)
 
         if qmodule:
             # There exists a qmodule associated with the graph node ``producer``
             # In this case, set the output quantizer of the producer to ``qtzr``
-            outputs = getattr(producer, 'output_products', [producer.output])
-            i = outputs.index(x)
+            i = output_positions[producer][id(x)]
             if isinstance(qmodule, custom.Split):
                 # torch.split is an output-variadic operation whose number of outputs
                 # can't be predicted statically.
@@ -166,17 +190,70 @@ def _propagate_output_encodings(sim: QuantizationSimModel,
             # 1. There is no qmodule associated with the graph node ``producer``, or
             # 2. qmodule is a math invariant op (reshape, permute, etc).
             # In these cases, propagate encoding further to the ancestors
-            for input in producer.inputs:
-                _set_src_qtzr(input, consumer=producer, qtzr=qtzr)
+            stack.extend((input, producer) for input in producer.inputs)
 
 
-    for op in reversed(cg.ordered_ops):
-        qmodule = get_qmodule(op)
+@overload
+def propagate_output_encodings(sim: QuantizationSimModel, module_type: Type[torch.nn.Module]):
+    """ Propagate output encodings of the given module type """
 
-        if not qmodule:
-            continue
 
-        if not condition(qmodule):
+@overload
+def propagate_output_encodings(sim: QuantizationSimModel, qmodule: torch.nn.Module):
+    """ Propagate output encodings of qmodule """
+
+
+@overload
+def propagate_output_encodings(sim: QuantizationSimModel, condition: Callable[[torch.nn.Module], bool]):
+    """ Propagate output encodings of all the modules that satisfies the given condition. """
+
+
+def propagate_output_encodings(sim: QuantizationSimModel, arg):
+    """ Propagate output encodings of all the modules that satisfies the given condition. """
+
+    if not sim.connected_graph:
+        msg = f"Couldn't find a traced graph from {type(sim).__qualname__}. "\
+              "propagate_output_encodings is only supported when traced graph is present "\
+              "as part of quantsim"
+        raise RuntimeError(msg)
+
+    _propagate_output_encodings(sim, arg)
+
+
+def _propagate_output_encodings(sim: QuantizationSimModel,
+                                arg: Union[Type[torch.nn.Module],
+                                           torch.nn.Module,
+                                           Callable[[torch.nn.Module], bool]]):
+    """
+    Propagate output encodings of all the modules that satisfies the given condition.
+
+    :param sim: Quantsim model to propagate output encodings for
+    :param arg: Module type, qmodule, or condition that selects the qmodules
+        to propagate output encodings of
+    """
+    cg = sim.connected_graph
+    qmodule_of_op, input_positions, output_positions = _index_ops(cg, sim.model)
+
+    # Narrow down the ops to propagate output encodings from before traversal
+    # if they can be selected without inspecting the quantizer states.
+    # NOTE: Arbitrary conditions may depend on the quantizers replaced by the propagation,
+    #       so they are evaluated lazily in reverse graph order during propagation
+    condition = None
+    if isinstance(arg, type) and issubclass(arg, torch.nn.Module):
+        module_type = arg
+        matching_qmodules = {qmodule for qmodule in qmodule_of_op.values()
+                             if isinstance(qmodule, module_type)}
+        candidate_ops = [op for op in cg.ordered_ops if qmodule_of_op.get(op) in matching_qmodules]
+    elif isinstance(arg, torch.nn.Module):
+        candidate_ops = [op for op in cg.ordered_ops if qmodule_of_op.get(op) is arg]
+    else:
+        condition = arg
+        candidate_ops = [op for op in cg.ordered_ops if op in qmodule_of_op]
+
+    for op in reversed(candidate_ops):
+        qmodule = qmodule_of_op[op]
+
+        if condition is not None and not condition(qmodule):
             continue
 
         if len(qmodule.output_quantizers) != 1:
@@ -192,8 +269,7 @@ def _propagate_output_encodings(sim: QuantizationSimModel,
                   '1 output quantizer, but found qmodule.output_quantizers[0] == None'
             raise RuntimeError(msg)
 
-        for input in op.inputs:
-            _set_src_qtzr(input, consumer=op, qtzr=qtzr)
+        _set_src_qtzr(op, qtzr, qmodule_of_op, input_positions, output_positions)
 
 def clip_weights_to_7f7f(sim: 'QuantizationSimModel'):
     """
@@ -202,22 +278,35 @@ def clip_weights_to_7f7f(sim: 'QuantizationSimModel'):
     :param sim: Quantsim model to clip weights for
     """
     affected_layers = []
-    for name, quant_layer in sim.named_qmodules():
-        # pylint: disable=too-many-boolean-expressions
-        if 'weight' in quant_layer.param_quantizers and \
-                quant_layer.param_quantizers['weight'] is not None and \
-                quant_layer.param_quantizers['weight'].bitwidth == 16 and \
-                isinstance(quant_layer.param_quantizers['weight'], AffineQuantizerBase) and \
-                quant_layer.param_quantizers['weight'].symmetric and \
-                quant_layer.param_quantizers['weight'].is_initialized():
-            clipped_weight = torch.minimum(quant_layer.weight,
-                                           quant_layer.param_quantizers['weight'].get_scale() * 0x7f7f)
-            with torch.no_grad():
-                quant_layer.weight.copy_(clipped_weight)
-
+    with torch.no_grad():
+        for name, quant_layer in sim.named_qmodules():
+            param_quantizers = quant_layer.param_quantizers
+            if 'weight' not in param_quantizers:
+                continue
+
+            weight_qtzr = param_quantizers['weight']
+            if not _is_16bit_symmetric_initialized(weight_qtzr):
+                continue
+
+            # Clip in-place to avoid allocating an intermediate tensor as large as ``weight``.
+            # NOTE: Don't convert per-tensor bounds to python scalars with ``.item()``;
+            #       it forces a host-device sync per layer and stalls the asynchronous
+            #       kernel launches
+            weight = quant_layer.weight
+            torch.minimum(weight, weight_qtzr.get_scale() * 0x7f7f, out=weight)
             affected_layers.append(name)
-    logger_str = f'Clipping weights of the following layers to 0x7f7f max quantized value: {affected_layers}'
-    logger.debug(logger_str)
+
+    logger.debug('Clipping weights of the following layers to 0x7f7f max quantized value: %s',
+                 affected_layers)
+
+
+def _is_16bit_symmetric_initialized(quantizer) -> bool:
+    """ Returns True if quantizer is an initialized 16 bit symmetric affine quantizer """
+    return isinstance(quantizer, AffineQuantizerBase) and \
+        quantizer.bitwidth == 16 and \
+        quantizer.symmetric and \
+        quantizer.is_initialized()
+
 
 def set_matmul_second_input_producer_to_8bit_symmetric(sim: 'QuantizationSimModel'):
     """
@@ -225,54 +314,73 @@ def set_matmul_second_input_producer_to_8bit_symmetric(sim: 'QuantizationSimMode
     :param sim: Quantsim model to apply matmul exception
     """
     model_name = sim.connected_graph._model_name # pylint: disable=protected-access
-    quant_modules = {name: module for name, module in sim.model.named_modules()
+    # Key the qmodules by their fully-qualified names, the same way as ``op.dotted_name``
+    quant_modules = {name: module for name, module in sim.model.named_modules(prefix=model_name)
                      if isinstance(module, BaseQuantizationMixin)}
 
-    def get_connected_graph_op(connected_graph, model_name, name):
-        # pylint: disable=protected-access
-        original_module = connected_graph._name_to_module[f'{model_name}.{name}']
-        return connected_graph._module_to_op_dict[original_module]
+    # Cache of the closest producer of each op.
+    # MatMuls often share ancestors (e.g. Q/K/V projections of the same block),
+    # so this avoids re-walking the same chain of ops for every MatMul
+    producer_cache: Dict[Op, Optional[BaseQuantizationMixin]] = {}
 
     def get_closest_producer(op: Op):
-        quant_module = quant_modules.get(op.dotted_name.removeprefix(f'{model_name}.'), None)
-        if quant_module:
-            if quant_module.output_quantizers[0]:
-                return quant_module
-
-            if len(op.input_ops) == 1:
-                return get_closest_producer(op.input_ops[0])
-
-            logger.warning(
-                "A wrapper of %s with output quantization disabled has no input or more than one input exists. "
-                "It's ambiguous to find the nearest producer in this case", str(op.dotted_name))
-            return None
-
-        if not op.input_ops:
-            logger.warning("No input exists for navigation for traversal, aborting..")
-            return None
-
-        if len(op.input_ops) > 1:
-            logger.warning(
-            "Multiple input ops exist, traversal to find closest producer is performed based on the first input")
-
-        return get_closest_producer(op.input_ops[0])
-
-    for name, module in quant_modules.items():
-        if isinstance(module, custom.MatMul):
-            _, target_quantizer = module.input_quantizers
-            matmul_op = get_connected_graph_op(sim.connected_graph, model_name, name)
-            if not target_quantizer:
-                input_op = matmul_op.inputs[1].producer
-                if input_op:
-                    closest_producer_wrapper = get_closest_producer(input_op)
-                    if closest_producer_wrapper:
-                        target_quantizer = closest_producer_wrapper.output_quantizers[0]
-                    else:
-                        logger.warning(
-                            "The closest wrapper could not be found. MatMul exception rule does not apply. "
-                            "If you haven't used model preparer, consider using it.")
-
-            if target_quantizer:
-                target_quantizer.qmin = -128
-                target_quantizer.qmax = 127
-                target_quantizer.symmetric = True
+        # Walk up the ancestors iteratively to avoid hitting the recursion limit for deep models.
+        # All the ops visited along the way share the same closest producer
+        path = []
+        while op not in producer_cache:
+            path.append(op)
+            quant_module = quant_modules.get(op.dotted_name, None)
+            if quant_module:
+                if quant_module.output_quantizers[0]:
+                    closest_producer = quant_module
+                    break
+
+                if len(op.input_ops) == 1:
+                    op = op.input_ops[0]
+                    continue
+
+                logger.warning(
+                    "A wrapper of %s with output quantization disabled has no input or "
+                    "more than one input exists. "
+                    "It's ambiguous to find the nearest producer in this case", str(op.dotted_name))
+                closest_producer = None
+                break
+
+            if not op.input_ops:
+                logger.warning("No input exists for navigation for traversal, aborting..")
+                closest_producer = None
+                break
+
+            if len(op.input_ops) > 1:
+                logger.warning("Multiple input ops exist, traversal to find closest producer "
+                               "is performed based on the first input")
+
+            op = op.input_ops[0]
+        else:
+            closest_producer = producer_cache[op]
+
+        for visited_op in path:
+            producer_cache[visited_op] = closest_producer
+        return closest_producer
+
+    for matmul_op in sim.connected_graph.ordered_ops:
+        module = quant_modules.get(matmul_op.dotted_name, None)
+        if not isinstance(module, custom.MatMul):
+            continue
+
+        _, target_quantizer = module.input_quantizers
+        if not target_quantizer:
+            input_op = matmul_op.inputs[1].producer
+            if input_op:
+                closest_producer_wrapper = get_closest_producer(input_op)
+                if closest_producer_wrapper:
+                    target_quantizer = closest_producer_wrapper.output_quantizers[0]
+                else:
+                    logger.warning(
+                        "The closest wrapper could not be found. MatMul exception rule does not apply. "
+                        "If you haven't used model preparer, consider using it.")
+
+        if target_quantizer:
+            target_quantizer.qmin = -128
+            target_quantizer.qmax = 127
+            target_quantizer.symmetric = True
@@ -38,6 +38,7 @@
 
 import json
 import os
+import pytest
 import torch
 import tempfile
 from aimet_torch.examples.test_models import SingleResidualWithAvgPool
@@ -45,7 +46,8 @@ from aimet_torch.v2.quantsim import QuantizationSimModel
 from aimet_torch.v2.quantization.affine.backends.torch_builtins import quantize
 from aimet_torch.v2.experimental import clip_weights_to_7f7f
 
-def test_clip_weights_to_7f7f():
+@pytest.mark.parametrize('per_channel_quantization', ['True', 'False'])
+def test_clip_weights_to_7f7f(per_channel_quantization):
     torch.manual_seed(0)
     model = SingleResidualWithAvgPool().eval()
     dummy_input = torch.randn(1, 3, 32, 32)
@@ -66,7 +68,7 @@ def test_clip_weights_to_7f7f():
                     "is_quantized": "True",
                     "is_symmetric": "True"
                 },
-                "per_channel_quantization": "True",
+                "per_channel_quantization": per_channel_quantization,
             },
             "params": {},
             "op_type": {},
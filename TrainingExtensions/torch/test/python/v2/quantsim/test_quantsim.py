@@ -35,6 +35,7 @@
 #  @@-COPYRIGHT-END-@@
 # =============================================================================
 import contextlib
+import sys
 import torch
 import tempfile
 import os
@@ -1313,3 +1314,147 @@ class TestEncodingPropagation:
               to propagate the output encodings to.
         """
         propagate_output_encodings(sim, custom.Concat)
+
+    def test_stateful_condition(self):
+        """
+        Given: model as below, where q_out2 is 8-bit and the other quantizers are 16-bit
+
+          [x] -+-> concat1 -> q_out1 -> reshape -> q_r -> concat2 -> q_out2 -> [output]
+          [y] -+                                [z] ------^
+        """
+        class Model(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.cat1 = custom.Concat()
+                self.reshape = custom.Reshape()
+                self.cat2 = custom.Concat()
+
+            def forward(self, x, y, z):
+                t = self.cat1(x, y)
+                t = self.reshape(t, (-1, 3, 8, 8))
+                return self.cat2(t, z)
+
+        model = Model()
+        x = torch.randn(1, 3, 8, 8)
+        y = torch.randn(1, 3, 8, 8)
+        z = torch.randn(1, 3, 8, 8)
+        sim = QuantizationSimModel(model, (x, y, z), default_output_bw=16)
+        sim.model.cat2.output_quantizers[0].bitwidth = 8
+
+        """
+        When: Call propagate_output_encodings with a condition that depends on the quantizer state
+        Then: concat1 inherits q_out2 from concat2 before the condition is evaluated for concat1,
+              so concat1 is also selected and propagates q_out2 further to its inputs
+        """
+        def is_8bit_concat(module):
+            return isinstance(module, custom.Concat) and module.output_quantizers[0].bitwidth == 8
+
+        orig_q_out2 = sim.model.cat2.output_quantizers[0]
+        propagate_output_encodings(sim, is_8bit_concat)
+
+        assert sim.model.reshape.output_quantizers[0] is orig_q_out2
+        assert sim.model.cat1.output_quantizers[0] is orig_q_out2
+        assert sim.model.cat1.input_quantizers[0] is orig_q_out2
+        assert sim.model.cat2.input_quantizers[0] is orig_q_out2
+
+    def test_deep_math_invariant_chain(self):
+        """
+        Given: model as below, where the chain of reshapes is longer than the recursion limit
+
+          [x] -> conv -> q_out1 -> reshape_0 -> ... -> reshape_{N-1} -> concat -> q_out2 -> [output]
+          [y] -------------------------------------------------------------^
+        """
+        num_reshapes = sys.getrecursionlimit() + 100
+
+        class Model(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.conv = torch.nn.Conv2d(3,3,3, padding=1)
+                self.reshapes = torch.nn.ModuleList(custom.Reshape() for _ in range(num_reshapes))
+                self.cat = custom.Concat()
+
+            def forward(self, x, y):
+                x = self.conv(x)
+                for reshape in self.reshapes:
+                    x = reshape(x, (-1, 3, 8, 8))
+                return self.cat(x, y)
+
+        model = Model()
+        x = torch.randn(1, 3, 8, 8)
+        y = torch.randn(1, 3, 8, 8)
+
+        # Tracing the model into a connected graph requires a deeper stack than the model depth
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(recursion_limit * 10)
+        try:
+            sim = QuantizationSimModel(model, (x, y))
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+
+        """
+        When: Call propagate_output_encodings(concat)
+        Then: q_out2 is propagated through the entire chain of reshapes to conv
+              without hitting the recursion limit
+        """
+        assert num_reshapes > sys.getrecursionlimit()
+        propagate_output_encodings(sim, custom.Concat)
+
+        q_out2 = sim.model.cat.output_quantizers[0]
+        assert sim.model.conv.output_quantizers[0] is q_out2
+        assert all(reshape.output_quantizers[0] is q_out2 for reshape in sim.model.reshapes)
+
+    @pytest.mark.parametrize('num_calls', [1, 2])
+    def test_conflicting_candidates(self, num_calls):
+        """
+        Given: model as below. Note that cat_b lies between cat_c and cat_a in the graph order
+
+                     +-> reshape -+--------------------------------------------+
+                     |            +-> cat_c -+-------------------------------+ |
+          [x] -> conv_a        [y] ----^    +-> conv_c -+                     v v
+                     |                                   +-> cat_b -> conv_b -> cat_a -> q_out_a -> [output]
+                     +-----------------------------------+
+        """
+        class Model(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.conv_a = torch.nn.Conv2d(3,3,3, padding=1)
+                self.reshape = custom.Reshape()
+                self.cat_c = custom.Concat()
+                self.conv_c = torch.nn.Conv2d(3,3,3, padding=1)
+                self.cat_b = custom.Concat()
+                self.conv_b = torch.nn.Conv2d(3,3,3, padding=1)
+                self.cat_a = custom.Concat()
+
+            def forward(self, x, y):
+                a = self.conv_a(x)
+                r = self.reshape(a, (-1, 3, 8, 8))
+                c = self.cat_c(r, y)
+                b = self.cat_b(a, self.conv_c(c))
+                return self.cat_a(r, c, self.conv_b(b))
+
+        model = Model()
+        x = torch.randn(1, 3, 8, 8)
+        y = torch.randn(1, 3, 8, 8)
+        sim = QuantizationSimModel(model, (x, y))
+
+        """
+        When: Call propagate_output_encodings(concat) once or more
+        Then: 1. cat_a sets the output quantizers of reshape, conv_a, cat_c, and conv_b to q_out_a
+              2. cat_b then sets the output quantizers of conv_a and conv_c to q_out_b
+              3. cat_c, whose output quantizer is now q_out_a, sets the output quantizers of
+                 reshape and conv_a back to q_out_a, even though reshape already holds q_out_a
+        """
+        orig_q_out_a = sim.model.cat_a.output_quantizers[0]
+        orig_q_out_b = sim.model.cat_b.output_quantizers[0]
+
+        for _ in range(num_calls):
+            propagate_output_encodings(sim, custom.Concat)
+
+        assert sim.model.cat_a.output_quantizers[0] is orig_q_out_a
+        assert sim.model.cat_b.output_quantizers[0] is orig_q_out_b
+        assert sim.model.cat_c.output_quantizers[0] is orig_q_out_a
+        assert sim.model.reshape.output_quantizers[0] is orig_q_out_a
+        assert sim.model.conv_a.output_quantizers[0] is orig_q_out_a
+        assert sim.model.conv_b.output_quantizers[0] is orig_q_out_a
+        assert sim.model.conv_c.output_quantizers[0] is orig_q_out_b
+        assert sim.model.cat_c.input_quantizers[0] is orig_q_out_a
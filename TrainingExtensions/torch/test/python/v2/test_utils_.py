@@ -36,12 +36,14 @@
 # =============================================================================
 import json
 import os
+import sys
 import pytest
 import tempfile
 import torch
 
 from .models_.test_models import ModelWithMatMul2
 from aimet_common.defs import QuantScheme
+import aimet_torch.nn.modules.custom as aimet_modules
 from aimet_torch.v2.experimental import set_matmul_second_input_producer_to_8bit_symmetric
 from aimet_torch.v2.quantsim import QuantizationSimModel
 from aimet_torch.v2.utils import allow_recompute, enable_recompute, reduce, patch_attr
@@ -173,16 +175,7 @@ def test_allow_recompute(use_deterministic_algorithms):
     assert torch.equal(conv1_grad_with_recompute, conv1_grad_without_recompute)
     assert torch.equal(conv2_grad_with_recompute, conv2_grad_without_recompute)
 
-def test_matmul_bit_override():
-
-    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-
-    model = ModelWithMatMul2().to(device)
-    dummy_input = (
-        torch.randn(10, 3, 4, device=device),
-        torch.randn(10, 5, 4, device=device),
-    )
-
+def _create_quantsim_with_matmul_exception(model, dummy_input):
     quantsim_config = {
         "defaults": {
             "hw_version": 'V79',
@@ -216,9 +209,153 @@ def test_matmul_bit_override():
     sim.compute_encodings(
         lambda sim_model, _: sim_model(*dummy_input), forward_pass_callback_args=None
     )
+    return sim
+
+
+def test_matmul_bit_override():
+
+    device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+    model = ModelWithMatMul2().to(device)
+    dummy_input = (
+        torch.randn(10, 3, 4, device=device),
+        torch.randn(10, 5, 4, device=device),
+    )
+
+    sim = _create_quantsim_with_matmul_exception(model, dummy_input)
+    set_matmul_second_input_producer_to_8bit_symmetric(sim)
+
+    closest_output_quantizer_of_second_input = sim.model.act3.output_quantizers[0]
+    assert closest_output_quantizer_of_second_input.bitwidth == 8
+    assert closest_output_quantizer_of_second_input.symmetric
+    assert closest_output_quantizer_of_second_input.signed
+
+
+def test_matmul_bit_override_deep_chain():
+    """
+    Given: MatMul whose second input is produced by softmax followed by a chain of ReLUs
+           with output quantization disabled. The chain is longer than the recursion limit
+    """
+    num_relus = sys.getrecursionlimit() + 100
+
+    class Model(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.act1 = torch.nn.PReLU()
+            self.act3 = torch.nn.Softmax(dim=-1)
+            self.relus = torch.nn.ModuleList(torch.nn.ReLU() for _ in range(num_relus))
+            self.matmul = aimet_modules.MatMul()
+
+        def forward(self, *inputs):
+            x = self.act1(inputs[0])
+            y = self.act3(inputs[1])
+            for relu in self.relus:
+                y = relu(y)
+            return self.matmul(x, y)
+
+    model = Model()
+    dummy_input = (torch.randn(10, 3, 4), torch.randn(10, 4, 5))
+
+    # Tracing the model into a connected graph requires a deeper stack than the model depth
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(recursion_limit * 10)
+    try:
+        sim = _create_quantsim_with_matmul_exception(model, dummy_input)
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+
+    """
+    When: Call set_matmul_second_input_producer_to_8bit_symmetric
+    Then: Softmax output quantizer is found across the whole chain and set to 8-bit symmetric
+    """
+    assert num_relus > sys.getrecursionlimit()
     set_matmul_second_input_producer_to_8bit_symmetric(sim)
 
     closest_output_quantizer_of_second_input = sim.model.act3.output_quantizers[0]
     assert closest_output_quantizer_of_second_input.bitwidth == 8
     assert closest_output_quantizer_of_second_input.symmetric
     assert closest_output_quantizer_of_second_input.signed
+
+    assert sim.model.act1.output_quantizers[0].bitwidth == 16
+
+
+def test_matmul_bit_override_shared_ancestors():
+    """
+    Given: Two MatMuls whose second inputs trace back to the same softmax
+           through ReLUs with output quantization disabled
+
+      [input0] -> act1 ---------------------------+------------> matmul1
+                                                  +------------> matmul2
+      [input1] -> act3 -> act2 -> reshape -+-> relu1 ------------^  ^
+                                           +-> relu2 ---------------+
+    """
+    class Model(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.act1 = torch.nn.PReLU()
+            self.act2 = torch.nn.ReLU()
+            self.act3 = torch.nn.Softmax(dim=-1)
+            self.relu1 = torch.nn.ReLU()
+            self.relu2 = torch.nn.ReLU()
+            self.matmul1 = aimet_modules.MatMul()
+            self.matmul2 = aimet_modules.MatMul()
+
+        def forward(self, *inputs):
+            x = self.act1(inputs[0])
+            y = self.act3(inputs[1])
+            y = self.act2(y)
+            y = y.reshape(10, 4, 5)
+            return self.matmul1(x, self.relu1(y)), self.matmul2(x, self.relu2(y))
+
+    model = Model()
+    dummy_input = (torch.randn(10, 3, 4), torch.randn(10, 5, 4))
+    sim = _create_quantsim_with_matmul_exception(model, dummy_input)
+
+    """
+    When: Call set_matmul_second_input_producer_to_8bit_symmetric
+    Then: Softmax output quantizer is set to 8-bit symmetric,
+          while the output quantizer of the first input producer stays unchanged
+    """
+    set_matmul_second_input_producer_to_8bit_symmetric(sim)
+
+    closest_output_quantizer_of_second_input = sim.model.act3.output_quantizers[0]
+    assert closest_output_quantizer_of_second_input.bitwidth == 8
+    assert closest_output_quantizer_of_second_input.symmetric
+    assert closest_output_quantizer_of_second_input.signed
+
+    assert sim.model.act1.output_quantizers[0].bitwidth == 16
+
+
+def test_matmul_bit_override_reused_matmul():
+    """
+    Given: One MatMul module called twice, with second inputs produced by different softmaxes
+    """
+    class Model(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.act1 = torch.nn.PReLU()
+            self.act3a = torch.nn.Softmax(dim=-1)
+            self.act3b = torch.nn.Softmax(dim=-1)
+            self.matmul = aimet_modules.MatMul()
+
+        def forward(self, *inputs):
+            x = self.act1(inputs[0])
+            return self.matmul(x, self.act3a(inputs[1])), self.matmul(x, self.act3b(inputs[2]))
+
+    model = Model()
+    dummy_input = (torch.randn(10, 3, 4), torch.randn(10, 4, 5), torch.randn(10, 4, 5))
+    sim = _create_quantsim_with_matmul_exception(model, dummy_input)
+
+    """
+    When: Call set_matmul_second_input_producer_to_8bit_symmetric
+    Then: Output quantizers of both softmaxes are set to 8-bit symmetric
+    """
+    set_matmul_second_input_producer_to_8bit_symmetric(sim)
+
+    for act3 in (sim.model.act3a, sim.model.act3b):
+        closest_output_quantizer_of_second_input = act3.output_quantizers[0]
+        assert closest_output_quantizer_of_second_input.bitwidth == 8
+        assert closest_output_quantizer_of_second_input.symmetric
+        assert closest_output_quantizer_of_second_input.signed
+
+    assert sim.model.act1.output_quantizers[0].bitwidth == 16